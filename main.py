@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 import vdf
 import json
@@ -7,9 +8,20 @@ import logging
 import argparse
 from sys import exit
 from pathlib import Path
-from binascii import crc32
+from operator import attrgetter
+from zlib import crc32
 from getpass import getpass
 
+try:
+    import orjson
+    json_loads = orjson.loads
+    def json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+except ImportError:
+    json_loads = json.loads
+    def json_dumps(obj):
+        return json.dumps(obj, indent=4)
+
 def get_exe_dir():
     # https://pyinstaller.org/en/stable/runtime-information.html
     if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
@@ -51,6 +63,9 @@ parser.add_argument(
 parser.add_argument(
     '-r', '--remove-old', action='store_true', required=False,
     help='remove old manifest on update')
+parser.add_argument(
+    '--no-crc', action='store_true', required=False,
+    help='skip calculating crc_clear of manifest, steam tolerates it in depotcache')
 parser.add_argument(
     '-o', '--save-path', required=False,
     help='where to save the manifest')
@@ -84,50 +99,164 @@ from steam.webauth import WebAuth
 from steam.client import SteamClient
 from steam.core.connection import WebsocketConnection
 from steam.client.cdn import CDNClient, CDNDepotManifest
+from steam.exceptions import ManifestError
 from steam.enums import EResult, EBillingType
-from steam.protobufs.content_manifest_pb2 import ContentManifestSignature
+
+FILENAME_STRIP_CHARS = '\x00 \n\t'
+UINT32 = struct.Struct('<I')
+SECTION_HEADER = struct.Struct('<II')
+
+def dmg_write_manifest(manifest_path: Path, manifest: CDNDepotManifest, payload: bytes):
+    # write sections straight to the file instead of building the whole
+    # manifest in memory first like CDNDepotManifest.serialize() does
+    with open(manifest_path, 'wb', buffering=1 << 20) as f:
+        for magic, part in (
+                (CDNDepotManifest.PROTOBUF_PAYLOAD_MAGIC, payload),
+                (CDNDepotManifest.PROTOBUF_METADATA_MAGIC, manifest.metadata.SerializeToString()),
+                (CDNDepotManifest.PROTOBUF_SIGNATURE_MAGIC, manifest.signature.SerializeToString())):
+            f.write(SECTION_HEADER.pack(magic, len(part)))
+            f.write(part)
+        f.write(UINT32.pack(CDNDepotManifest.PROTOBUF_ENDOFMANIFEST_MAGIC))
+
+def dmg_list_dir(path: Path):
+    # one directory listing instead of a stat() per manifest
+    try:
+        with os.scandir(path) as it:
+            return {entry.name for entry in it}
+    except FileNotFoundError:
+        return set()
+
+# config.vdf normally only holds {'depots': {depot_id: {'DecryptionKey': key}}},
+# read and write that shape directly and leave anything else to the vdf module
+DEPOT_KEY_RE = re.compile(r'"(\d+)"\s*\{\s*"DecryptionKey"\s*"([0-9a-fA-F]+)"\s*\}')
+
+def dmg_load_config(save_path: Path):
+    try:
+        with open(save_path / 'config.vdf') as f:
+            text = f.read()
+    except FileNotFoundError:
+        return {}
+    matches = DEPOT_KEY_RE.findall(text)
+    if len(matches) == text.count('DecryptionKey') == text.count('{') - 1:
+        return {depot_id: {'DecryptionKey': key} for depot_id, key in matches}
+    return vdf.loads(text).get('depots', {})
+
+def dmg_dump_config(save_path: Path, depots: dict):
+    with open(save_path / 'config.vdf', 'w') as f:
+        if not all(isinstance(depot, dict) and depot.keys() == {'DecryptionKey'}
+                   for depot in depots.values()):
+            vdf.dump({'depots': depots}, f, pretty=True)
+            return
+        f.write('"depots"\n{\n')
+        f.write(''.join(f'\t"{depot_id}"\n\t{{\n\t\t"DecryptionKey" "{depot["DecryptionKey"]}"\n\t}}\n'
+                        for depot_id, depot in depots.items()))
+        f.write('}\n')
+
+def dmg_seed_depot_keys(cdn: CDNClient, save_path: Path):
+    # CDNClient caches depot keys for the session, also reuse the ones
+    # saved by previous runs so they are not requested again
+    seeded = set()
+    for depot_id, depot in dmg_load_config(save_path).items():
+        try:
+            key = bytes.fromhex(depot['DecryptionKey'])
+            if len(key) != 32:
+                raise ValueError('depot keys are 32 bytes')
+            depot_id = int(depot_id)
+        except (KeyError, TypeError, ValueError):
+            log.warning(f"invalid DecryptionKey for depot '{depot_id}' in {save_path / 'config.vdf'}, ignored")
+            continue
+        if depot_id not in cdn.depot_keys:
+            cdn.depot_keys[depot_id] = key
+            seeded.add(depot_id)
+    return seeded
+
+def dmg_fetch_with_saved_keys(cdn: CDNClient, save_path: Path, fetch):
+    # manifests are decrypted while fetching, a stale saved key makes that
+    # fail, so forget the saved keys and let Steam hand out fresh ones
+    seeded = dmg_seed_depot_keys(cdn, save_path)
+    try:
+        return fetch()
+    except (ManifestError, RuntimeError) as e:
+        if not seeded:
+            raise
+        log.warning(f'{e}, requesting depot keys saved in {save_path / "config.vdf"} again')
+        for depot_id in seeded:
+            cdn.depot_keys.pop(depot_id, None)
+        return fetch()
+
+def dmg_sort_mappings(mappings):
+    # hot loop for large manifests, bind the helpers it calls to locals
+    sha_key = attrgetter('sha')
+    strip_chars = FILENAME_STRIP_CHARS
+    upper_keys = []
+    add_key = upper_keys.append
+    upper = str.upper
+    for mapping in mappings:
+        filename = mapping.filename.rstrip(strip_chars)
+        mapping.filename = filename
+        add_key(upper(filename))
+        mapping.chunks.sort(key=sha_key)
+    # sort() computes each key once in list order, so hand out the cached keys
+    next_key = iter(upper_keys).__next__
+    mappings.sort(key=lambda _: next_key())
 
 def dmg_save_manifest(manifest: CDNDepotManifest, depot_key: bytes,
-                      remove_old=False, save_path=None):
+                      remove_old=False, save_path=None, dir_cache=None):
     app_id = int(manifest.app_id)
     depot_id = str(manifest.depot_id)
     manifest_gid = str(manifest.gid)
     if not save_path:
         save_path = Path().absolute() / f'depots/{app_id}'
     manifest_path = save_path / f'{depot_id}_{manifest_gid}.manifest'
-    if manifest_path.exists():
+    if dir_cache is not None:
+        # manifests on disk, listed once per directory
+        if save_path not in dir_cache:
+            dir_cache[save_path] = dmg_list_dir(save_path)
+        existing = dir_cache[save_path]
+        if manifest_path.name in existing:
+            return True, manifest_path, []
+    elif manifest_path.exists():
         return True, manifest_path, []
     log.info("app_id: %s | depot_id: %s | manifest_gid: %s | DecryptionKey: %s",
              app_id, depot_id, manifest_gid, depot_key.hex())
     manifest.decrypt_filenames(depot_key)
-    manifest.signature = ContentManifestSignature()
-    for mapping in manifest.payload.mappings:
-        mapping.filename = mapping.filename.rstrip('\x00 \n\t')
-        mapping.chunks.sort(key=lambda x: x.sha)
-    manifest.payload.mappings.sort(key=lambda x: x.filename.upper())
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
-    if os.path.isfile(save_path / 'config.vdf'):
-        with open(save_path / 'config.vdf') as f:
-            d = vdf.load(f)
-    else:
-        d = vdf.VDFDict({'depots': {}})
-    d['depots'][depot_id] = {'DecryptionKey': depot_key.hex()}
-    d = {'depots': dict(sorted(d['depots'].items()))}
+    manifest.signature.Clear()
+    dmg_sort_mappings(manifest.payload.mappings)
+    save_path.mkdir(parents=True, exist_ok=True)
+    depots = dmg_load_config(save_path)
+    # config.vdf is always written sorted, only re-sort when a depot is added
+    config_changed = depots.get(depot_id, {}).get('DecryptionKey') != depot_key.hex()
+    if config_changed:
+        new_depot = depot_id not in depots
+        depots.setdefault(depot_id, {})['DecryptionKey'] = depot_key.hex()
+        if new_depot:
+            depots = dict(sorted(depots.items()))
     delete_list = []
     if remove_old:
-        for file in save_path.iterdir():
-            if file.suffix == '.manifest':
-                depot_id_, manifest_gid_ = file.stem.split('_')
-                if depot_id_ == str(depot_id) and manifest_gid_ != str(manifest_gid):
-                    file.unlink(missing_ok=True)
-                    delete_list.append(file.name)
+        with os.scandir(save_path) as it:
+            for entry in it:
+                name = entry.name
+                if not name.endswith('.manifest'):
+                    continue
+                depot_id_, _, manifest_gid_ = name[:-len('.manifest')].partition('_')
+                if depot_id_ == depot_id and manifest_gid_ != manifest_gid:
+                    try:
+                        os.unlink(entry.path)
+                    except FileNotFoundError:
+                        pass
+                    delete_list.append(name)
+    # serialize payload only once, reuse it for crc_clear and the file body
     buffer = manifest.payload.SerializeToString()
-    manifest.metadata.crc_clear = crc32(struct.pack('<I', len(buffer)) + buffer)
-    with open(manifest_path, 'wb') as f:
-        f.write(manifest.serialize(compress=False))
-    with open(save_path / 'config.vdf', 'w') as f:
-        vdf.dump(d, f, pretty=True)
+    if args.no_crc:
+        manifest.metadata.crc_clear = 0
+    else:
+        manifest.metadata.crc_clear = crc32(buffer, crc32(UINT32.pack(len(buffer))))
+    dmg_write_manifest(manifest_path, manifest, buffer)
+    if dir_cache is not None:
+        existing.difference_update(delete_list)
+        existing.add(manifest_path.name)
+    if config_changed:
+        dmg_dump_config(save_path, depots)
     return True, manifest_path, delete_list
 
 def dmg_filter_func(depot_id: int, depot_info: dict):
@@ -143,7 +272,7 @@ refresh_tokens = {}
 if os.path.isfile(args.credential_file):
     with open(args.credential_file) as f:
         try:
-            lf = json.load(f)
+            lf = json_loads(f.read())
             if isinstance(lf, dict):
                 refresh_tokens = lf
         except:
@@ -180,7 +309,7 @@ def get_token(username='', password=''):
         auth.cli_login(username, password)
         with open(args.credential_file, 'w') as f:
             refresh_tokens.update({username: auth.refresh_token})
-            json.dump(refresh_tokens, f, indent=4)
+            f.write(json_dumps(refresh_tokens))
         return auth.refresh_token
     except Exception as e:
         log.error(f'Unknown exception: {e}')
@@ -224,11 +353,11 @@ if args.workshop_id:
 
     for workshop_id in workshop_id_list:
         log.info(f'Downloading workshop item {workshop_id}')
-        manifest = cdn.get_manifest_for_workshop_item(workshop_id)
+        save_path = args.save_path or Path().absolute() / 'workshop' / str(workshop_id)
+        manifest = dmg_fetch_with_saved_keys(
+            cdn, save_path, lambda: cdn.get_manifest_for_workshop_item(workshop_id))
         depot_key = cdn.get_depot_key(manifest.app_id, manifest.depot_id)
-        dmg_save_manifest(
-            manifest, depot_key, args.remove_old,
-            args.save_path or Path().absolute() / 'workshop' / str(workshop_id))
+        dmg_save_manifest(manifest, depot_key, args.remove_old, save_path)
 
     exit(0)
 
@@ -248,11 +377,15 @@ else:
         EBillingType.Rental,
         EBillingType.ProofOfPrepurchaseOnly,
         EBillingType.Gift]
-    packages = list(map(lambda l: {'packageid': l.package_id, 'access_token': l.access_token},
-                        client.licenses.values()))
-    for package_id, info in client.get_product_info(packages=packages)['packages'].items():
-        if 'appids' in info and 'depotids' in info and info['billingtype'] in paidtype_list:
-            app_id_list.extend(list(info['appids'].values()))
+    packages = [{'packageid': l.package_id, 'access_token': l.access_token}
+                for l in client.licenses.values()]
+    # query in batches so each response can be freed before the next one,
+    # access tokens come from the licenses so skip the extra token request
+    for i in range(0, len(packages), 500):
+        resp = client.get_product_info(packages=packages[i:i + 500], auto_access_tokens=False)
+        for package_id, info in resp['packages'].items():
+            if 'appids' in info and 'depotids' in info and info['billingtype'] in paidtype_list:
+                app_id_list.extend(info['appids'].values())
 
 if len(app_id_list) == 0:
     log.error('No app found')
@@ -265,14 +398,20 @@ if args.only_info:
         log.info("%s | %s | %s", app_id, app['common']['type'].upper(), app['common']['name'])
         exit()
 
+dir_cache = {}
+licensed_ids = set(cdn.licensed_depot_ids)
+licensed_ids.update(cdn.licensed_app_ids)
 for app_id in app_id_list:
-    if not int(app_id) in {*cdn.licensed_depot_ids, *cdn.licensed_app_ids}:
+    if not int(app_id) in licensed_ids:
         log.warning(f"account '{USERNAME}' not owned '{app_id}', ignored")
         continue
     save_path = args.save_path / f'depots/{app_id}' if isinstance(args.save_path, Path) else ''
-    for manifest in cdn.get_manifests(app_id, args.branch, filter_func=dmg_filter_func):
+    manifests = dmg_fetch_with_saved_keys(
+        cdn, save_path or Path().absolute() / f'depots/{app_id}',
+        lambda: cdn.get_manifests(app_id, args.branch, filter_func=dmg_filter_func))
+    for manifest in manifests:
         depot_key = cdn.get_depot_key(manifest.app_id, manifest.depot_id)
-        dmg_save_manifest(manifest, depot_key, args.remove_old, save_path)
+        dmg_save_manifest(manifest, depot_key, args.remove_old, save_path, dir_cache)
 
 client.logout()
 log.info('done!')
\ No newline at end of file